@@ -14,15 +14,36 @@ The input must be a Numbers.app sheet.
 """
 
 import argparse
+import sys
+from collections import Counter, deque
+from collections.abc import Callable, Iterable, Iterator, ValuesView
 from datetime import datetime, timedelta, timezone
 from email.message import EmailMessage
+from functools import lru_cache
+from operator import attrgetter, itemgetter
 from os.path import dirname, join, realpath
+from typing import Any
 
 import outgoing
 from numbers_parser import Document
 
 DIGESTION_TIME = timedelta(hours=24)
 """At most how long after food is eaten might it contribute to poop quality?"""
+DIGESTION_NS = DIGESTION_TIME // timedelta(microseconds=1) * 1000
+"""DIGESTION_TIME in nanoseconds, for comparing against row timestamps."""
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+PST = timezone(-timedelta(hours=8), "PST")
+"""Timezone assumed for sheet datetimes that don't specify one."""
+
+FOOD, GOOD_POOP, BAD_POOP = 0, 1, -1
+"""Row types, as small ints so they're cheap to compare."""
+ROW_TYPES = {"good poop": GOOD_POOP, "bad poop": BAD_POOP}
+"""Row types by event. Rows with any other event are food."""
+
+MIN_CONFIDENCE = 0.9
+"""Foods with less confidence than this are left out of the results."""
 
 IGNORE_FOODS = {"450.0"}
 ALIASES = {
@@ -50,6 +71,38 @@ INGREDIENTS = {
 }
 
 
+def resolve_ingredients(name: str) -> frozenset[str]:
+    """Return the names of a food and all of its ingredients, recursively."""
+    resolved: set[str] = set()
+    stack = [name]
+    while stack:
+        n = stack.pop()
+        n = ALIASES.get(n, n)
+        if n in resolved:
+            continue
+        resolved.add(n)
+        stack.extend(INGREDIENTS.get(n, ()))
+    return frozenset(resolved)
+
+
+RESOLVED_INGREDIENTS = {name: resolve_ingredients(name) for name in INGREDIENTS}
+"""INGREDIENTS, expanded ahead of time to include ingredients of ingredients."""
+
+
+@lru_cache(maxsize=None)
+def canonical_name(name: str) -> str:
+    """Return the name a food is tracked under."""
+    name = name.strip().lower()
+    return ALIASES.get(name, name)
+
+
+@lru_cache(maxsize=None)
+def component_names(name: str) -> frozenset[str]:
+    """Return the names of the components of a food, including the food itself."""
+    name = canonical_name(name)
+    return RESOLVED_INGREDIENTS.get(name, frozenset({name}))
+
+
 class Arguments(argparse.Namespace):
     """Command-line arguments."""
 
@@ -64,109 +117,89 @@ class Food:
         self.name = name
         self.num_good_poops = 0
         self.num_bad_poops = 0
+        self.quality = 0.0
+        self.confidence = 0.0
 
-    def addpoop(self, pooptype: str):
-        """Add a poop event that came soon after this food."""
-        if pooptype == Poop.GOOD:
-            self.num_good_poops += 1
-        elif pooptype == Poop.BAD:
-            self.num_bad_poops += 1
+    def addpoop(self, pooptype: int, count: int = 1):
+        """Add poop events that came soon after this food."""
+        if pooptype == GOOD_POOP:
+            self.num_good_poops += count
+        elif pooptype == BAD_POOP:
+            self.num_bad_poops += count
 
-    def quality(self) -> float:
+    def finalize(self) -> None:
         """
-        Return the quality of poops caused by this food.
+        Score the food once all of its poops have been added.
 
         The quality is a float, where 0 is very bad (every occurrence is
         followed by a bad poop). There is no absolute upper bound, but
         effectively the maximum will be the number of times the food was eaten.
+
+        Confidence in the quality is a float between 0 and 1, where 1 is
+        impossibly confident.
         """
+        total = self.num_good_poops + self.num_bad_poops
         if self.num_bad_poops == 0:
-            return 0
-        return float(self.num_good_poops) / float(self.num_bad_poops)
+            self.quality = 0.0
+        else:
+            self.quality = self.num_good_poops / self.num_bad_poops
+        self.confidence = (total / (total + 1) - 0.5) * 2
 
-    def confidence(self) -> float:
-        """
-        Return the confidence in the food quality.
 
-        Confience is a float between 0 and 1, where 1 is impossibly confident.
-        """
-        return (
-            (
-                float(self.num_good_poops + self.num_bad_poops)
-                / float(self.num_good_poops + self.num_bad_poops + 1)
-            )
-            - 0.5
-        ) * 2
-
-
-class Poop:
-    """A wrapper around a poop row."""
-
-    BAD: str = "bad poop"
-    GOOD: str = "good poop"
-
-    def __init__(self, index: int, datetime: datetime, type: str):
-        """Initialize the poop from a row."""
-        if type.lower() not in {Poop.BAD, Poop.GOOD}:
-            raise Exception(f"Invalid poop type: {type}")
-
-        self.index = index
-        self.datetime = datetime
-        self.type = type
-
-
-class Row:
-    """A row of data in the Numbers sheet."""
-
-    POOP: str = "poop"
-    FOOD: str = "food"
-
-    class NoTimestampError(Exception):
-        """An exception raised when the row has no date."""
-
-        def __init__(self, msg: str):
-            """Initialize the exception."""
-            self.msg = msg
-
-        def __str__(self):
-            """Return the exception message."""
-            return f"No timestamp on row: {self.msg}"
-
-    def __init__(self, row) -> None:
-        """Initialize the row from a Numbers row."""
-        self._row = row
-
-        dt: str | datetime | None = row[0].value
-        try:
-            ev: str = str(row[1].value).strip().lower()
-        except AttributeError as e:
-            raise AttributeError(f"Invalid event: {row[1].value}") from e
-
-        # self.index = row[0].value
-        if isinstance(dt, datetime):
-            self.datetime = dt
-        elif isinstance(dt, str):
-            try:
-                self.datetime = datetime.fromisoformat(dt)
-            except TypeError as e:
-                raise self.NoTimestampError(
-                    f"Invalid datetime: {dt} (type {dt.__class__}): {e}",
-                )
-        else:
-            raise self.NoTimestampError(
-                f"Invalid datetime: {dt} (type {dt.__class__})",
-            )
+def timestamp_ns(dt: datetime) -> int:
+    """Return an aware datetime as integer nanoseconds since the epoch."""
+    return (dt - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def parse_event(event) -> str:
+    """Normalize the event of a Numbers row."""
+    # Events repeat heavily, so intern them to share one string per event.
+    return sys.intern(str(event).strip().lower())
 
-        if self.datetime and self.datetime.tzinfo is None:
-            self.datetime = self.datetime.replace(
-                tzinfo=timezone(-timedelta(hours=8), "PST")
-            )
-        self.event = ev
-        self.type = self.POOP if ev in {"good poop", "bad poop"} else Row.FOOD
 
-    def to_poop(self) -> Poop:
-        """Return the row as a Poop type."""
-        return Poop(-1, self.datetime, self.event)
+def parse_isoformat(value: str) -> datetime | None:
+    """Parse an ISO 8601 string, or return None if it isn't one."""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+DATETIME_PARSERS: dict[type, Callable[[Any], datetime | None]] = {
+    datetime: lambda dt: dt,
+    str: parse_isoformat,
+}
+"""How to read each type of value found in the datetime column."""
+
+
+def parse_timestamps(values: list[str | datetime | None]) -> list[int | None]:
+    """
+    Parse a column of Numbers datetimes into nanoseconds since the epoch.
+
+    Naive datetimes are assumed to be in PST. Datetimes (and subclasses of
+    datetime) and ISO 8601 strings are accepted; anything else becomes None.
+    """
+    # Dispatch on the exact type, which is cheaper than isinstance() checks.
+    parsers = DATETIME_PARSERS
+    pst = PST
+
+    timestamps: list[int | None] = []
+    for value in values:
+        parser = parsers.get(type(value))
+        if parser is None:
+            # Subclasses like pandas.Timestamp miss the exact-type lookup.
+            if isinstance(value, datetime):
+                parser = parsers[datetime]
+            elif isinstance(value, str):
+                parser = parsers[str]
+        dt = parser(value) if parser else None
+        if dt is None:
+            timestamps.append(None)
+            continue
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=pst)
+        timestamps.append(timestamp_ns(dt))
+    return timestamps
 
 
 class Cupboard:
@@ -178,23 +211,77 @@ class Cupboard:
 
     def get(self, name: str) -> Food:
         """Get a food from the cupboard."""
-        name = name.strip().lower()
-        name = ALIASES.get(name, name)
-        if name not in self._foods:
-            self._foods[name] = Food(name)
-        return self._foods[name]
-
-    def components(self, name: str) -> set[Food]:
+        # Most lookups are by canonical name, so try that before normalizing.
+        food = self._foods.get(name)
+        if food is None:
+            name = canonical_name(name)
+            if name not in self._foods:
+                self._foods[name] = Food(name)
+            food = self._foods[name]
+        return food
+
+    def components(self, name: str) -> frozenset[Food]:
         """Return the components of a food, including the food itself."""
-        food = self.get(name)
-        s: set[Food] = {food}
-        for f in INGREDIENTS.get(food.name, set()):
-            s.update(self.components(f))
-        return s
+        return frozenset(self.get(n) for n in component_names(name))
 
-    def all(self) -> set[Food]:
-        """Return all foods in the cupboard."""
-        return set(self._foods.values())
+    def all(self) -> ValuesView[Food]:
+        """Return a live view of all foods in the cupboard."""
+        return self._foods.values()
+
+
+def read_rows(table) -> Iterator[tuple[int, str, int]]:
+    """
+    Yield the timestamp, event and type of each usable row in a Numbers table.
+
+    Timestamps are integer nanoseconds since the epoch, so comparing them
+    doesn't allocate a timedelta the way subtracting datetimes does.
+
+    The datetime column is parsed in an up-front pass before any rows are
+    yielded, so this holds the column and its timestamps in memory rather than
+    streaming row by row.
+    """
+    rows = table.rows(values_only=True)[1:]
+    # Parse the whole datetime column up front, apart from the events.
+    timestamps = parse_timestamps([row[0] for row in rows])
+    for ts, (_, ev, *_) in zip(timestamps, rows):
+        # TODO: Use data even when no datetime is present.
+        if ts is None or ev in {None, ""}:
+            continue
+        ev = parse_event(ev)
+        yield ts, ev, ROW_TYPES.get(ev, FOOD)
+
+
+def correlate(
+    rows: Iterable[tuple[int, str, int]],
+) -> tuple[Counter[str], Counter[str]]:
+    """
+    Count the good and bad poops that followed each food event.
+
+    Rows must be sorted by timestamp. They are consumed in a single pass, only
+    keeping foods eaten within DIGESTION_TIME of the current row in memory.
+    Counts are keyed by raw event rather than by food, so ingredients only
+    need to be resolved once per event instead of once per (poop, food) pair.
+    """
+    # Bind globals to locals once, since they're read on every iteration.
+    digestion_ns = DIGESTION_NS
+    food, good_poop = FOOD, GOOD_POOP
+    ignore_foods = IGNORE_FOODS
+
+    good_counts: Counter[str] = Counter()
+    bad_counts: Counter[str] = Counter()
+    window: deque[tuple[int, str]] = deque()
+
+    for ts, ev, rowtype in rows:
+        while window and ts - window[0][0] >= digestion_ns:
+            window.popleft()
+        if rowtype == food:
+            if ev not in ignore_foods:
+                window.append((ts, ev))
+            continue
+        counts = good_counts if rowtype == good_poop else bad_counts
+        counts.update(map(itemgetter(1), window))
+
+    return good_counts, bad_counts
 
 
 def send_email(subject: str, text_body: str, html_body: str) -> None:
@@ -226,43 +313,37 @@ def main(email=False) -> None:
 
     cupboard: Cupboard = Cupboard()
 
-    rows: list[Row] = []
-    for row in tables[0].rows()[1:]:
-        # TODO: Use data even when no datetime is present.
-        if row[1] in {None, ""}:
-            continue
-        try:
-            rows.append(Row(row))
-        except Row.NoTimestampError:
-            continue
-
-    for pooprow in rows:
-        if pooprow.type != Row.POOP:
-            continue
-        poop = pooprow.to_poop()
-        # For each poop row, go find recent food rows and tag them
-        for foodrow in rows:
-            if foodrow.type != Row.FOOD or foodrow.event in IGNORE_FOODS:
-                continue
-            if abs(poop.datetime - foodrow.datetime) < timedelta(hours=24):
-                for food in cupboard.components(foodrow.event):
-                    food.addpoop(poop.type)
-
-    s = ""
-    longest_food_name = max(len(food.name) for food in cupboard.all())
-    s += f"+ {'-' * longest_food_name}-+---------+------------+\n"
-    s += f"| {'food'.rjust(longest_food_name, ' ')} | quality | confidence |\n"
-    s += f"+ {'-' * longest_food_name}-+---------+------------+\n"
-    for food in sorted(list(cupboard.all()), key=lambda f: f.quality()):
-        if food.confidence() < 0.9:
-            continue
-        s += (
-            f"| {food.name.rjust(longest_food_name, ' ')} |"
-            f" {food.quality():.2f}    |"
-            f" {food.confidence():.2f}       |"
+    # The sheet is appended to in order, but older entries can still be edited
+    # or backfilled. Sorting rows that are already in order is a linear pass.
+    rows = sorted(read_rows(tables[0]), key=itemgetter(0))
+    good_counts, bad_counts = correlate(rows)
+
+    for pooptype, counts in ((GOOD_POOP, good_counts), (BAD_POOP, bad_counts)):
+        for event, count in counts.items():
+            for food in cupboard.components(event):
+                food.addpoop(pooptype, count)
+
+    foods = cupboard.all()
+    for food in foods:
+        food.finalize()
+
+    longest_food_name = max(len(food.name) for food in foods)
+    border = f"+ {'-' * longest_food_name}-+---------+------------+\n"
+    parts: list[str] = [
+        border,
+        f"| {'food':>{longest_food_name}} | quality | confidence |\n",
+        border,
+    ]
+    confident = [f for f in foods if f.confidence >= MIN_CONFIDENCE]
+    for food in sorted(confident, key=attrgetter("quality")):
+        parts.append(
+            f"| {food.name:>{longest_food_name}} |"
+            f" {food.quality:.2f}    |"
+            f" {food.confidence:.2f}       |"
             f"\n"
         )
-    s += f"+{'-' * longest_food_name}--+---------+------------+\n"
+    parts.append(f"+{'-' * longest_food_name}--+---------+------------+\n")
+    s = "".join(parts)
 
     print(s)
     if email: